@@ -0,0 +1,145 @@
+from pathlib import Path
+from argparse import ArgumentParser
+from typing import Any, Dict, List
+import sys
+import json
+import shutil
+import platform
+import tempfile
+
+from corpus import REPO_ROOT, generate_sized_corpus
+from run import run_measured, tree_size
+
+sys.path.insert(0, str(REPO_ROOT))
+from packer import parse_size
+
+# Packer options of every measured format
+FORMATS = {
+    "legacy": ["-f", "legacy"],
+    "indexed": [],
+    "indexed-zlib": ["-c", "zlib", "-b", "1M"],
+}
+
+# Run in a child process to measure compiling a pack on its own: the
+# time and traced memory of compile() alone, and the process' peak RSS
+COMPILE_SCRIPT = """
+import sys, time, json, tracemalloc
+source = open(sys.argv[1], "rb").read()
+tracemalloc.start()
+tracemalloc.reset_peak()
+start = time.perf_counter()
+compile(source, sys.argv[1], "exec")
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "peak_traced": tracemalloc.get_traced_memory()[1]}))
+"""
+
+def parse_arguments(args: List[str]) -> Dict[str, Any]:
+    "Parses the command-line arguments given to the compile cost benchmark"
+
+    parser = ArgumentParser(
+        description="""
+            Packs trees of increasing size in every format and measures
+            compiling the unpacker, starting it and extracting it, to
+            show how each format's costs grow with the payload.
+        """
+    )
+
+    parser.add_argument(
+        "-o", "--output", type=Path, default=None,
+        help="Path of the JSON results. Defaults to printing them."
+    )
+
+    parser.add_argument(
+        "--sizes", type=parse_size, nargs="+", default=[parse_size(size) for size in ("1M", "10M", "100M", "1G")],
+        help="Sizes of the packed trees, for example '10M'. Defaults to 1M 10M 100M 1G."
+    )
+
+    parser.add_argument(
+        "--format", nargs="+", default=list(FORMATS), choices=list(FORMATS),
+        help="Formats to measure. Defaults to all of them."
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the generated trees. Defaults to 0."
+    )
+
+    parser.add_argument(
+        "--work", type=Path, default=Path(tempfile.gettempdir())/"packer-compile-cost",
+        help="Directory holding the trees, packs and extracted trees. Trees are reused across runs."
+    )
+
+    return parser.parse_args(args).__dict__
+
+def measure_format(work: Path, corpus: str, fmt: str) -> Dict[str, Any]:
+    """
+    Packs a tree in one format, then measures compiling the unpacker,
+    starting it up to its argument parsing, and extracting every file.
+    The pack and the extracted files are removed afterwards.
+    """
+
+    pack = work/f"{corpus}-{fmt}.py"
+    target = work/f"{corpus}-{fmt}.out"
+    shutil.rmtree(target, ignore_errors=True)
+    try:
+        pack_seconds, pack_rss = run_measured([
+            sys.executable, str(REPO_ROOT/"packer.py"), corpus, "-o", str(pack), "--force", "-q", *FORMATS[fmt]
+        ], work)
+
+        result_path = work/"compile.json"
+        _, compile_rss = run_measured([sys.executable, "-c", COMPILE_SCRIPT, str(pack)], work, result_path)
+        compiled = json.loads(result_path.read_text())
+
+        # Both formats parse their arguments before touching their
+        # members, so --help measures compiling and starting the unpacker
+        startup_seconds, startup_rss = run_measured([sys.executable, str(pack), "--help"], work)
+        extract_seconds, extract_rss = run_measured([sys.executable, str(pack), "-o", str(target), "-q"], work)
+
+        return {
+            "format": fmt,
+            "output_bytes": pack.stat().st_size,
+            "pack_seconds": round(pack_seconds, 6),
+            "pack_peak_rss": pack_rss,
+            "compile_seconds": round(compiled["seconds"], 6),
+            "compile_peak_traced": compiled["peak_traced"],
+            "compile_peak_rss": compile_rss,
+            "startup_seconds": round(startup_seconds, 6),
+            "startup_peak_rss": startup_rss,
+            "extract_seconds": round(extract_seconds, 6),
+            "extract_peak_rss": extract_rss,
+        }
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+        if pack.exists():
+            pack.unlink()
+
+def main(args: Dict[str, Any]):
+    work: Path = args["work"]
+    work.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for size in args["sizes"]:
+        corpus = generate_sized_corpus(work, size, args["seed"])
+        files, input_bytes = tree_size(work/corpus)
+        for fmt in args["format"]:
+            result = {"size": size, "files": files, "input_bytes": input_bytes, **measure_format(work, corpus, fmt)}
+            print(
+                f"{size / 1024 ** 2:>8.0f} MiB  {fmt:<14}"
+                f"compile {result['compile_seconds']:8.3f} s {result['compile_peak_traced'] / 1024 ** 2:8.1f} MiB  "
+                f"startup {result['startup_seconds']:8.3f} s  "
+                f"extract {result['extract_seconds']:8.3f} s {result['extract_peak_rss'] / 1024 ** 2:8.1f} MiB",
+                file=sys.stderr
+            )
+            results.append(result)
+
+    report = json.dumps({
+        "run": {"python": platform.python_version(), "platform": platform.platform(), "seed": args["seed"]},
+        "results": results,
+    }, indent=2)
+    if args["output"] is None:
+        print(report)
+    else:
+        args["output"].write_text(report + "\n")
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
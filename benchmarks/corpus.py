@@ -0,0 +1,148 @@
+from pathlib import Path
+from typing import Callable, Dict, List
+import random
+import subprocess
+import sys
+import shutil
+
+# Root of the repository, holding packer.py and the packed examples
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Words the synthetic source files are made of
+WORDS = (
+    "def", "class", "return", "import", "from", "self", "value", "items", "path",
+    "data", "for", "in", "if", "else", "None", "True", "False", "print", "args",
+    "result", "name", "size", "index", "block", "stream", "offset", "=", "+",
+    "(", ")", ":", ",", "[", "]", "{", "}", "#", "0", "1", "42",
+)
+
+# Fragments that exercise escaping: quote runs, backslashes and line ends
+TRICKY = ("'''", '"""', "\\", "\\\\", "'", '"', "r'\\d+'", "\\n", "''''", "\\'''")
+
+def make_text(rng: random.Random, size: int, tricky: float = 0.0) -> str:
+    """Makes roughly `size` characters of source-like text, with a share of escaping-heavy fragments"""
+
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(
+            rng.choice(TRICKY) if rng.random() < tricky else rng.choice(WORDS)
+            for _ in range(rng.randint(1, 12))
+        )
+        line = "    " * rng.randint(0, 3) + line
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines) + "\n"
+
+def write_file(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8", newline="\n")
+
+def make_tiny(root: Path, rng: random.Random, scale: float):
+    """Many tiny files spread over a few directories"""
+
+    for i in range(int(5000 * scale)):
+        write_file(root/f"pkg{i % 50}"/f"mod{i}.py", make_text(rng, rng.randint(20, 400)))
+
+def make_huge(root: Path, rng: random.Random, scale: float):
+    """A few files of several megabytes"""
+
+    for i in range(3):
+        write_file(root/f"huge{i}.py", make_text(rng, int(8 * 1024 * 1024 * scale)))
+
+def make_deep(root: Path, rng: random.Random, scale: float):
+    """A deeply nested chain of directories with a few files at every level"""
+
+    path = root
+    for depth in range(max(int(60 * scale), 2)):
+        path = path/f"level{depth}"
+        for i in range(3):
+            write_file(path/f"file{i}.py", make_text(rng, rng.randint(200, 2000)))
+
+def make_wide(root: Path, rng: random.Random, scale: float):
+    """One directory with thousands of subdirectories holding one file each"""
+
+    for i in range(int(3000 * scale)):
+        write_file(root/f"dir{i}"/"__init__.py", make_text(rng, rng.randint(50, 500)))
+
+def make_quotes(root: Path, rng: random.Random, scale: float):
+    """Files full of quote runs and backslashes"""
+
+    for i in range(int(400 * scale)):
+        write_file(root/f"quotes{i}.py", make_text(rng, rng.randint(1000, 20000), tricky=0.3))
+
+def make_duplicates(root: Path, rng: random.Random, scale: float):
+    """Thousands of files sharing a handful of distinct contents"""
+
+    contents = [make_text(rng, rng.randint(500, 20000)) for _ in range(20)]
+    for i in range(int(3000 * scale)):
+        write_file(root/f"copy{i % 30}"/f"vendored{i}.py", rng.choice(contents))
+
+# Synthetic corpora by name
+SYNTHETIC: Dict[str, Callable[[Path, random.Random, float], None]] = {
+    "tiny": make_tiny,
+    "huge": make_huge,
+    "deep": make_deep,
+    "wide": make_wide,
+    "quotes": make_quotes,
+    "duplicates": make_duplicates,
+}
+
+def extract_examples(work: Path) -> List[str]:
+    """Extracts the packed examples shipped in packed_modules, returning the names of their trees"""
+
+    names = []
+    for example in sorted((REPO_ROOT/"packed_modules").glob("*_packed.py")):
+        name = example.stem[:-len("_packed")]
+        target = work/f"example-{name}"
+        if not target.exists():
+            temp = work/f"example-{name}.tmp"
+            shutil.rmtree(temp, ignore_errors=True)
+            subprocess.run(
+                [sys.executable, str(example), "-o", str(temp)],
+                check=True, stdout=subprocess.DEVNULL
+            )
+            temp.rename(target)
+        names.append(target.name)
+    return names
+
+def generate_corpora(work: Path, names: List[str], seed: int = 0, scale: float = 1.0) -> List[str]:
+    """
+    Generates the named synthetic corpora under `work`, each from its own
+    random generator seeded with `seed`, so the same arguments always
+    give the same trees. Corpora that already exist for the same seed and
+    scale are kept. Returns the names of the corpus directories.
+    """
+
+    generated = []
+    for name in names:
+        target = work/f"{name}-{seed}-{scale:g}"
+        if not target.exists():
+            temp = work/f"{target.name}.tmp"
+            shutil.rmtree(temp, ignore_errors=True)
+            temp.mkdir(parents=True)
+            SYNTHETIC[name](temp, random.Random(f"{name}:{seed}"), scale)
+            temp.rename(target)
+        generated.append(target.name)
+    return generated
+
+def generate_sized_corpus(work: Path, size: int, seed: int = 0) -> str:
+    """
+    Generates a tree of about `size` bytes of 1 MiB files, for measuring
+    how costs grow with the size of a pack. The files repeat a pool of
+    chunks to keep generation fast, each behind its own header line so
+    that no two files are identical.
+    """
+
+    target = work/f"sized-{size}-{seed}"
+    if not target.exists():
+        temp = work/f"{target.name}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        temp.mkdir(parents=True)
+
+        rng = random.Random(f"sized:{seed}")
+        chunks = [make_text(rng, 1024 * 1024 - 64) for _ in range(min(64, max(size // (1024 * 1024), 1)))]
+        for i in range(max(size // (1024 * 1024), 1)):
+            write_file(temp/f"part{i // 100}"/f"file{i}.py", f"# file {i}\n" + chunks[i % len(chunks)])
+        temp.rename(target)
+    return target.name
@@ -0,0 +1,399 @@
+from pathlib import Path
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import functools
+
+from corpus import REPO_ROOT, SYNTHETIC, extract_examples, generate_corpora
+
+# Packer options of every benchmarked configuration, and whether its
+# unpacker takes a number of threads
+CONFIGS = {
+    "indexed": ([], True),
+    "indexed-zlib": (["-c", "zlib", "-b", "1M"], True),
+    "indexed-lzma": (["-c", "lzma", "-b", "1M"], True),
+    "legacy": (["-f", "legacy"], False),
+}
+
+# Compared metrics, the kind of tolerance applying to each, and whether
+# higher values are better. Sizes are compared without the unpacker's
+# code, so only changes to how the files are stored count
+METRICS = {
+    "pack_bytes_per_second": ("throughput", True),
+    "unpack_bytes_per_second": ("throughput", True),
+    "pack_peak_rss": ("memory", False),
+    "unpack_peak_rss": ("memory", False),
+    "payload_bytes": ("size", False),
+    "compile_seconds": ("compile", False),
+}
+
+# Default relative change allowed for each kind of metric before it
+# counts as a regression
+TOLERANCES = {
+    "throughput": 0.15,
+    "memory": 0.10,
+    "size": 0.01,
+    "compile": 0.20,
+}
+
+# Multiple of the interquartile range a metric can move by from noise
+# alone, as in Tukey's fences
+NOISE_FACTOR = 1.5
+
+# Baseline compared against by default, committed with the repository
+DEFAULT_BASELINE = Path(__file__).resolve().parent/"baseline.json"
+
+# Run in a child process that starts every measured command. The peak RSS
+# wait4 reports for a child includes the memory of the process it was
+# forked from, so commands are forked from this small process rather than
+# from the runner, which grows with the packs it reads. Reads a JSON list
+# of the command, its directory and the file its output goes to per line,
+# and answers each with its wall time, exit code and ru_maxrss
+MEASURE_SCRIPT = """
+import os, sys, json, time, subprocess
+for line in sys.stdin:
+    command, cwd, stdout = json.loads(line)
+    with open(stdout or os.devnull, "wb") as output:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=output)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    print(json.dumps([seconds, os.waitstatus_to_exitcode(status), usage.ru_maxrss]), flush=True)
+"""
+
+def parse_tolerance(text: str) -> Tuple[str, float]:
+    """Parses a KIND=FRACTION tolerance, such as throughput=0.2"""
+
+    kind, _, fraction = text.partition("=")
+    if kind not in TOLERANCES:
+        raise ArgumentTypeError(f"unknown metric kind {kind!r}, expected one of {', '.join(TOLERANCES)}")
+    try:
+        return kind, float(fraction)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid tolerance {fraction!r}") from None
+
+def parse_arguments(args: List[str]) -> Dict[str, Any]:
+    "Parses the command-line arguments given to the benchmark runner"
+
+    parser = ArgumentParser(
+        description="""
+            Packs and unpacks synthetic trees and the packed examples
+            with every configuration, measuring throughput, output size
+            and peak memory, and writes the results as JSON.
+        """
+    )
+
+    parser.add_argument(
+        "-o", "--output", type=Path, default=None,
+        help="Path of the JSON results. Defaults to printing them."
+    )
+
+    parser.add_argument(
+        "--corpus", nargs="+", default=[*SYNTHETIC, "examples"], choices=[*SYNTHETIC, "examples"],
+        help="Corpora to benchmark. Defaults to all of them."
+    )
+
+    parser.add_argument(
+        "--config", nargs="+", default=list(CONFIGS), choices=list(CONFIGS),
+        help="Configurations to benchmark. Defaults to all of them."
+    )
+
+    parser.add_argument(
+        "--scale", type=float, default=None,
+        help="""Factor applied to the number and size of the synthetic files.
+                Defaults to the baseline's with --check, otherwise to 1."""
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="Seed of the synthetic corpora. Defaults to the baseline's with --check, otherwise to 0."
+    )
+
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="""Number of threads given to the packer and the unpacker.
+                Defaults to the baseline's with --check, otherwise to 1."""
+    )
+
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="Number of measured runs of every benchmark, reported as their median and IQR. Defaults to 1."
+    )
+
+    parser.add_argument(
+        "--warmup", type=int, default=0,
+        help="Number of unmeasured runs of every benchmark before the measured ones. Defaults to 0."
+    )
+
+    parser.add_argument(
+        "--check", action="store_true",
+        help="""Compare the results against the baseline and exit with status 1
+                if any metric regressed by more than its tolerance"""
+    )
+
+    parser.add_argument(
+        "--baseline", type=Path, default=DEFAULT_BASELINE,
+        help="Path of the baseline results. Defaults to benchmarks/baseline.json."
+    )
+
+    parser.add_argument(
+        "--update-baseline", action="store_true",
+        help="Write the results to the baseline instead of comparing against it"
+    )
+
+    parser.add_argument(
+        "--tolerance", type=parse_tolerance, action="append", default=[],
+        help=f"""Relative change allowed for a kind of metric, as KIND=FRACTION.
+                 Can be repeated. Defaults to {', '.join(f'{k}={v}' for k, v in TOLERANCES.items())}."""
+    )
+
+    parser.add_argument(
+        "--work", type=Path, default=Path(tempfile.gettempdir())/"packer-benchmarks",
+        help="Directory holding the corpora, packs and extracted trees. Corpora are reused across runs."
+    )
+
+    parsed = parser.parse_args(args)
+    if parsed.check and parsed.update_baseline:
+        parser.error("--check and --update-baseline are exclusive")
+
+    # Settings left out match the baseline when checking against it, so
+    # the same trees are measured
+    defaults = {"scale": 1.0, "seed": 0, "jobs": 1}
+    if parsed.check:
+        if not parsed.baseline.exists():
+            parser.error(f"{parsed.baseline} does not exist, make it with --update-baseline")
+        defaults.update(json.loads(parsed.baseline.read_text())["run"])
+    for setting in ("scale", "seed", "jobs"):
+        if getattr(parsed, setting) is None:
+            setattr(parsed, setting, defaults[setting])
+
+    return parsed.__dict__
+
+def tree_size(path: Path) -> Tuple[int, int]:
+    """Returns the number of files under a directory and their total size"""
+
+    files = 0
+    size = 0
+    for parent, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(parent, name))
+    return files, size
+
+@functools.lru_cache(maxsize=None)
+def measurer() -> subprocess.Popen:
+    """Starts the process measured commands are run from, once per runner"""
+
+    return subprocess.Popen(
+        [sys.executable, "-c", MEASURE_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+
+def run_measured(command: List[str], cwd: Path, stdout: Optional[Path] = None) -> Tuple[float, int]:
+    """
+    Runs a command to completion, returning its wall time in seconds and
+    the peak resident set size of its process in bytes. Its output is
+    written to `stdout` when given, and discarded otherwise.
+    """
+
+    process = measurer()
+    process.stdin.write(json.dumps([command, str(cwd), str(stdout) if stdout is not None else None]) + "\n")
+    process.stdin.flush()
+    seconds, returncode, maxrss = json.loads(process.stdout.readline())
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return seconds, maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def measure_stub(work: Path, corpus: str, config: str) -> int:
+    """
+    Returns the size of the pack of an empty tree with the same name as a
+    corpus, which is the part of its packs that does not depend on its files
+    """
+
+    empty = work/"empty"
+    (empty/corpus).mkdir(parents=True, exist_ok=True)
+    pack = empty/f"{corpus}-{config}.py"
+    subprocess.run([
+        sys.executable, str(REPO_ROOT/"packer.py"), corpus, "-o", str(pack), "--force", "-q", *CONFIGS[config][0]
+    ], cwd=empty, check=True)
+    return pack.stat().st_size
+
+def measure_once(work: Path, corpus: str, config: str, size: int, stub_bytes: int,
+                 jobs: int = 1) -> Dict[str, float]:
+    """Packs and unpacks one corpus with one configuration once, returning every metric"""
+
+    pack_args, threaded = CONFIGS[config]
+    pack = work/"packs"/f"{corpus}-{config}.py"
+    target = work/"unpacked"/f"{corpus}-{config}"
+    pack.parent.mkdir(parents=True, exist_ok=True)
+    shutil.rmtree(target, ignore_errors=True)
+
+    # The packer is run from the work directory so the tree is packed
+    # under its own name, like the packer's command line expects
+    pack_seconds, pack_rss = run_measured([
+        sys.executable, str(REPO_ROOT/"packer.py"), corpus, "-o", str(pack),
+        "--force", "-q", "-j", str(jobs), *pack_args
+    ], work)
+    unpack_args = ["-q", "-j", str(jobs)] if threaded else ["-q"]
+    unpack_seconds, unpack_rss = run_measured([sys.executable, str(pack), "-o", str(target), *unpack_args], work)
+
+    # Compiling is what every run of the unpacker pays before doing anything
+    source = pack.read_bytes()
+    start = time.perf_counter()
+    compile(source, str(pack), "exec")
+    compile_seconds = time.perf_counter() - start
+
+    return {
+        "output_bytes": len(source),
+        "payload_bytes": len(source) - stub_bytes,
+        "pack_seconds": pack_seconds,
+        "pack_bytes_per_second": size / pack_seconds,
+        "pack_peak_rss": pack_rss,
+        "unpack_seconds": unpack_seconds,
+        "unpack_bytes_per_second": size / unpack_seconds,
+        "unpack_peak_rss": unpack_rss,
+        "compile_seconds": compile_seconds,
+    }
+
+def run_benchmark(work: Path, corpus: str, config: str, jobs: int = 1,
+                  repeat: int = 1, warmup: int = 0) -> Dict[str, Any]:
+    """
+    Packs and unpacks one corpus with one configuration `warmup` times
+    without measuring, then `repeat` times, returning the median of every
+    metric along with its interquartile range
+    """
+
+    files, size = tree_size(work/corpus)
+    stub_bytes = measure_stub(work, corpus, config)
+    for _ in range(warmup):
+        measure_once(work, corpus, config, size, stub_bytes, jobs)
+    samples = [measure_once(work, corpus, config, size, stub_bytes, jobs) for _ in range(max(repeat, 1))]
+
+    result = {"corpus": corpus, "config": config, "files": files, "input_bytes": size, "repeat": len(samples)}
+    iqr = {}
+    for metric in samples[0]:
+        values = [sample[metric] for sample in samples]
+        result[metric] = round(statistics.median(values), 6)
+        if len(values) > 1:
+            quartiles = statistics.quantiles(values, n=4)
+            iqr[metric] = round(quartiles[2] - quartiles[0], 6)
+        else:
+            iqr[metric] = 0.0
+    result["iqr"] = iqr
+    return result
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+            tolerances: Dict[str, float]) -> List[str]:
+    """
+    Compares results against baseline results of the same corpora and
+    configurations, returning a description of every regression. A metric
+    regresses when it is worse than the baseline by more than its
+    tolerance, plus NOISE_FACTOR times the larger of the two interquartile
+    ranges so that noise alone does not count as a regression.
+    """
+
+    expected = {(result["corpus"], result["config"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = expected.get((result["corpus"], result["config"]))
+        if reference is None:
+            continue
+
+        for metric, (kind, higher_is_better) in METRICS.items():
+            if metric not in result or metric not in reference:
+                continue
+
+            current, previous = result[metric], reference[metric]
+            noise = NOISE_FACTOR * max(result.get("iqr", {}).get(metric, 0.0), reference.get("iqr", {}).get(metric, 0.0))
+            allowed = previous * tolerances[kind] + noise
+            change = previous - current if higher_is_better else current - previous
+            if change > allowed:
+                regressions.append(
+                    f"{result['corpus']} {result['config']} {metric}: "
+                    f"{previous:g} -> {current:g} ({change / previous:+.1%} worse, "
+                    f"{allowed / previous:.1%} allowed)" if previous else
+                    f"{result['corpus']} {result['config']} {metric}: {previous:g} -> {current:g}"
+                )
+    return regressions
+
+def describe_run(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns what identifies a run: the commit, the interpreter, the machine and the settings"""
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args["scale"],
+        "seed": args["seed"],
+        "jobs": args["jobs"],
+    }
+
+def main(args: Dict[str, Any]):
+    work: Path = args["work"]
+    work.mkdir(parents=True, exist_ok=True)
+
+    synthetic = [name for name in args["corpus"] if name != "examples"]
+    corpora = generate_corpora(work, synthetic, args["seed"], args["scale"])
+    if "examples" in args["corpus"]:
+        corpora += extract_examples(work)
+
+    results = []
+    for corpus in corpora:
+        for config in args["config"]:
+            result = run_benchmark(work, corpus, config, args["jobs"], args["repeat"], args["warmup"])
+            print(
+                f"{corpus:<32}{config:<14}"
+                f"pack {result['pack_bytes_per_second'] / 1e6:8.1f} MB/s  "
+                f"unpack {result['unpack_bytes_per_second'] / 1e6:8.1f} MB/s  "
+                f"size {result['output_bytes'] / result['input_bytes']:6.2f}x",
+                file=sys.stderr
+            )
+            results.append(result)
+
+    run = describe_run(args)
+    report = json.dumps({"run": run, "results": results}, indent=2)
+    if args["update_baseline"]:
+        args["baseline"].write_text(report + "\n")
+    elif args["output"] is None:
+        print(report)
+    else:
+        args["output"].write_text(report + "\n")
+
+    if not args["check"]:
+        return
+
+    # Results only compare to a baseline measured on the same trees
+    baseline = json.loads(args["baseline"].read_text())
+    for setting in ("scale", "seed", "jobs"):
+        if baseline["run"].get(setting) != run[setting]:
+            sys.exit(
+                f"The baseline was measured with {setting}={baseline['run'].get(setting)}, "
+                f"not {run[setting]}"
+            )
+
+    regressions = compare(results, baseline["results"], {**TOLERANCES, **dict(args["tolerance"])})
+    for regression in regressions:
+        print("Regression:", regression, file=sys.stderr)
+    if regressions:
+        sys.exit(f"{len(regressions)} metrics regressed against {args['baseline']}")
+    print(f"No regression against {args['baseline']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
@@ -1,12 +1,104 @@
 #!/usr/bin/env python
 from pathlib import Path
-from argparse import ArgumentParser
-from typing import Any, List, Dict
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import (
+    Any, List, Dict, Iterator, Iterable, Optional, Tuple, Callable, TypeVar, ContextManager, BinaryIO,
+    NamedTuple, Union,
+)
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import contextlib
+import functools
+import io
 import sys
 import os
+import re
+import json
+import zlib
+import hashlib
+import threading
+import time
+import tracemalloc
+import codecs
+import locale
+import lzma
+import bz2
+import base64
 import jinja2
 
-unpacker_template = """# MIT License
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Size of the buffered writer used when streaming the packed file
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Number of reads kept in flight per worker thread when packing in parallel
+JOBS_WINDOW_FACTOR = 4
+
+# Layouts of the generated unpacker. "legacy" stores the files in a dict
+# literal, "indexed" stores them in a payload block read by offset
+PACK_FORMATS = ("indexed", "legacy")
+
+# Compressors for the members of an indexed pack. Compressed members
+# are stored as base85 lines, so the pack stays plain text
+COMPRESSORS = {
+    "none": None,
+    "zlib": lambda data: zlib.compress(data, 9),
+    "lzma": lzma.compress,
+    "bz2": bz2.compress,
+}
+
+# Width of the base85 lines in the payload, short enough to survive
+# transfer channels that mangle long lines
+B85_LINE_WIDTH = 76
+
+# First line of every generated file, identifying the inputs it was made from
+FINGERPRINT_LINE = re.compile(rb"# packer-fingerprint: ([0-9a-f]+)\r?\n")
+
+# Number of leading bytes sampled to tell text files from binary ones
+SNIFF_SIZE = 8192
+
+# Default maximum size of the repack cache directory
+DEFAULT_CACHE_SIZE = 1024 ** 3
+
+# Version of the cached block files, part of their keys so blocks cached
+# in an older layout are never reused
+CACHE_BLOCK_VERSION = 3
+
+# How much is printed while packing: nothing, a single refreshed
+# progress line, or one line per file
+REPORT_MODES = ("quiet", "progress", "verbose")
+
+# Minimum number of seconds between two refreshes of the progress line
+PROGRESS_INTERVAL = 0.2
+
+# Phases timed by --stats, in the order they are reported
+STATS_PHASES = ("walk", "filter", "read", "hash", "encode", "compress", "render", "write")
+
+# Number of allocation sites reported by --memory-profile
+MEMORY_TOP_SITES = 10
+
+# Growth of the traced memory, as a fraction of the last snapshot, after
+# which --memory-profile snapshots the allocation sites again
+MEMORY_SNAPSHOT_GROWTH = 0.1
+
+# Name given to the unpacker in its help when it is written to a stream without a name
+DEFAULT_PACK_NAME = "packed.py"
+
+# Per-directory files containing gitignore-style rules
+IGNORE_FILES = (".gitignore", ".packerignore")
+
+# Settings rendered into both unpackers, so they report like the packer
+UNPACKER_SETTINGS = {
+    "progress_interval": PROGRESS_INTERVAL,
+    "memory_top_sites": MEMORY_TOP_SITES,
+    "memory_snapshot_growth": MEMORY_SNAPSHOT_GROWTH,
+}
+
+license_header = """# packer-fingerprint: {{ fingerprint }}
+# MIT License
 # 
 # Copyright (c) 2023 pyDataSuite - Joey Meadows
 # 
@@ -27,11 +119,199 @@ unpacker_template = """# MIT License
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+"""
+
+# Progress reporting and phase timing shared by both unpackers. Their
+# settings are rendered from the packer's own
+unpacker_reporting = """
+# Minimum number of seconds between two refreshes of the progress line
+PROGRESS_INTERVAL = {{ progress_interval }}
+
+# Number of allocation sites reported by --memory-profile
+MEMORY_TOP_SITES = {{ memory_top_sites }}
+
+# Growth of the traced memory, as a fraction of the last snapshot, after
+# which --memory-profile snapshots the allocation sites again
+MEMORY_SNAPSHOT_GROWTH = {{ memory_snapshot_growth }}
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+class Progress:
+    "Counts the members extracted, refreshing a single progress line at most every PROGRESS_INTERVAL seconds"
+
+    def __init__(self, total_files: int, total_bytes: int, show: bool = False):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.show = show
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.shown = self.start
 
+    def advance(self, size: int, files: int = 1):
+        self.files += files
+        self.bytes += size
+        now = time.monotonic()
+        if self.show and now - self.shown >= PROGRESS_INTERVAL:
+            self.shown = now
+            self.refresh(now)
+
+    def refresh(self, now: float):
+        elapsed = now - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total_bytes - self.bytes, 0) / rate if rate else 0.0
+        sys.stderr.write(
+            f"\\r{self.files}/{self.total_files} files"
+            f"  {format_size(self.bytes)}/{format_size(self.total_bytes)}"
+            f"  {format_size(rate)}/s  ETA {remaining:.0f}s\\033[K"
+        )
+        sys.stderr.flush()
+
+    def finish(self):
+        if self.show:
+            self.refresh(time.monotonic())
+            sys.stderr.write("\\n")
+            sys.stderr.flush()
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.start
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(elapsed, 6),
+            "bytes_per_second": round(self.bytes / elapsed) if elapsed > 0 else 0,
+        }
+
+class Stats:
+    "Wall time, CPU time, items, bytes and, with `memory`, peak traced memory of each phase of the extraction"
+
+    def __init__(self, phases: Tuple[str, ...], memory: bool = False):
+        self.phases = {phase: {"wall": 0.0, "cpu": 0.0, "items": 0, "bytes": 0, "peak_traced": 0} for phase in phases}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+        self.memory = memory
+        self.running = {}
+        self.peak = 0
+        self.snapshot_peak = 0
+        self.top_sites = []
+        if memory:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, phase: str, items: int = 1):
+        counts = {"items": items, "bytes": 0}
+        if self.memory:
+            self.sample(enter=phase)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            if self.memory:
+                self.sample(leave=phase)
+            with self.lock:
+                record = self.phases[phase]
+                record["wall"] += wall
+                record["cpu"] += cpu
+                record["items"] += counts["items"]
+                record["bytes"] += counts["bytes"]
+
+    def sample(self, enter: str = None, leave: str = None):
+        "Charges the peak since the last phase boundary to the running phases, snapshotting sites as it grows"
+
+        with self.lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            for phase in self.running:
+                self.phases[phase]["peak_traced"] = max(self.phases[phase]["peak_traced"], peak)
+            self.peak = max(self.peak, peak)
+
+            if peak > self.snapshot_peak * (1 + MEMORY_SNAPSHOT_GROWTH):
+                self.snapshot_peak = peak
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+                self.top_sites = [
+                    {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     "size": stat.size, "count": stat.count}
+                    for stat in snapshot.statistics("lineno")[:MEMORY_TOP_SITES]
+                ]
+            tracemalloc.reset_peak()
+
+            if enter is not None:
+                self.running[enter] = self.running.get(enter, 0) + 1
+            if leave is not None:
+                self.running[leave] -= 1
+                if not self.running[leave]:
+                    del self.running[leave]
+
+    def to_dict(self) -> Dict[str, Any]:
+        totals = {
+            "wall": round(time.perf_counter() - self.start, 6),
+            "cpu": round(time.process_time() - self.cpu_start, 6),
+            "phases": {
+                phase: {**record, "wall": round(record["wall"], 6), "cpu": round(record["cpu"], 6)}
+                for phase, record in self.phases.items()
+            },
+        }
+        if not self.memory:
+            for record in totals["phases"].values():
+                del record["peak_traced"]
+            return totals
+
+        self.sample()
+        totals["memory"] = {
+            "peak_traced": self.peak,
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+                       if resource is not None else None,
+            "top_sites": self.top_sites,
+        }
+        return totals
+
+    def format_table(self) -> str:
+        totals = self.to_dict()
+        peak = f"{'peak':>12}" if self.memory else ""
+        lines = [f"{'phase':<12}{'wall s':>10}{'cpu s':>10}{'items':>10}{'bytes':>14}{peak}"]
+        for phase, record in totals["phases"].items():
+            peak = f"{format_size(record['peak_traced']):>12}" if self.memory else ""
+            lines.append(
+                f"{phase:<12}{record['wall']:>10.3f}{record['cpu']:>10.3f}"
+                f"{record['items']:>10}{record['bytes']:>14}{peak}"
+            )
+        lines.append(f"{'total':<12}{totals['wall']:>10.3f}{totals['cpu']:>10.3f}")
+
+        if self.memory:
+            memory = totals["memory"]
+            lines.append(f"peak traced memory {format_size(memory['peak_traced'])}")
+            if memory["max_rss"] is not None:
+                lines.append(f"max resident set size {format_size(memory['max_rss'])}")
+            lines.append("top allocation sites at the peak:")
+            for site in memory["top_sites"]:
+                lines.append(f"{format_size(site['size']):>12}{site['count']:>10}  {site['site']}")
+        return "\\n".join(lines)
+"""
+
+unpacker_template = license_header + """
 from pathlib import Path
 from argparse import ArgumentParser
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Tuple
+from base64 import b85decode
 import sys
+import json
+import time
+import threading
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def parse_arguments(args: List[str]) -> Dict[str, Any]:
     "Parses the command-line arguments given to the unpacker tool"
@@ -50,37 +330,483 @@ def parse_arguments(args: List[str]) -> Dict[str, Any]:
         default=None, help="Path to generate the output. Defaults to this filename."
     )
 
-    return parser.parse_args(args).__dict__
+    report = parser.add_mutually_exclusive_group()
+    report.add_argument(
+        "-q", "--quiet", dest="report", action="store_const", const="quiet",
+        help="Print nothing but errors and the summary"
+    )
+    report.add_argument(
+        "--progress", dest="report", action="store_const", const="progress",
+        help="Show a single progress line. The default when writing to a terminal."
+    )
+    report.add_argument(
+        "-v", "--verbose", dest="report", action="store_const", const="verbose",
+        help="Print every directory and file as it is created"
+    )
+
+    parser.add_argument(
+        "--summary", action="store_true",
+        help="Print a JSON summary of the extraction as the last line of the output"
+    )
 
+    parser.add_argument(
+        "--stats", nargs="?", const="table", default=None, choices=("table", "json"),
+        help="Time every phase of the extraction. Prints a table on stderr, or a JSON line with --stats json."
+    )
+
+    parsed = parser.parse_args(args)
+    if parsed.report is None:
+        parsed.report = "progress" if sys.stderr.isatty() else "quiet"
+    return parsed.__dict__
+""" + unpacker_reporting + """
 args = parse_arguments(sys.argv[1:])
 output_root: Path = args["output"]
 if output_root is None:
     output_root = Path(__file__).parent/f"{Path(__file__).stem}"
 
-print(f"Unpacking to {output_root}")
+report = args["report"]
+if report != "quiet":
+    print(f"Unpacking to {output_root}")
 
 dirs = [
     {% for dir in dirs %}"{{ dir }}",
     {% endfor %}]
 
-files = { 
-    {% for file in files %}
-    "{{ file.name }}": \"""{{ file.text }}\""",
+# The literals are compiled with the rest of this file, building the dict
+# and decoding its base85 blocks is what is timed{% set packed = namespace(bytes=0) %}
+stats = Stats(("decode", "mkdir", "write"))
+with stats.measure("decode", 0) as counts:
+    # Indentation does not matter inside the braces, so the members
+    # are not indented further and every file costs no extra bytes
+    files = { 
+    {% for file in files %}{% set packed.bytes = packed.bytes + file.size %}
+    "{{ file.name }}": {{ file.literal }},
     {% endfor %} 
-}
+    }
+    counts["items"] = len(files)
+    counts["bytes"] = total_bytes = {{ packed.bytes }}
 
+# Only directories without subdirectories are listed, creating them
+# creates their parents
 for d in dirs:
-    d = (output_root/d).resolve()
-    print("Created Directory:", d)
-    d.mkdir(exist_ok=True, parents=True)
+    d = output_root/d
+    if report == "verbose":
+        print("Created Directory:", d)
+    with stats.measure("mkdir"):
+        d.mkdir(exist_ok=True, parents=True)
 
+# Sizes are counted in bytes of UTF-8 text, like the packer counts them
+progress = Progress(len(files), total_bytes, report == "progress")
 for f, t in files.items():
-    f = (output_root/f).resolve()
-    print("Created File:", f)
-    f.write_text(t)
+    f = output_root/f
+    with stats.measure("write") as counts:
+        if isinstance(t, bytes):
+            size = f.write_bytes(t)
+        else:
+            f.write_text(t)
+            size = len(t.encode("utf-8"))
+        counts["bytes"] = size
+    if report == "verbose":
+        print("Created File:", f)
+    progress.advance(size)
+progress.finish()
+
+if args["stats"] == "json":
+    print(json.dumps(stats.to_dict()))
+elif args["stats"] == "table":
+    print(stats.format_table(), file=sys.stderr)
+
+if args["summary"]:
+    print(json.dumps({"output": str(output_root), "failed": 0, **progress.summary()}))
 
 """
 
+indexed_unpacker_template = license_header + """
+from pathlib import Path
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Dict, Tuple
+import os
+import io
+import sys
+import re
+import json
+import zlib
+import codecs
+import locale
+import base64
+import shutil
+import importlib
+import threading
+import time
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Size of the fixed-width line at the end of this file locating the index
+TRAILER_SIZE = {{ trailer_size }}
+
+# Size of the reads used when copying verbatim members out of this file
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Whether writing text with the default encoding and line endings leaves
+# UTF-8 text with newline endings unchanged
+NATIVE_TEXT = os.linesep == "\\n" and codecs.lookup(locale.getpreferredencoding(False)).name == "utf-8"
+
+# Members are grouped into blocks of comment lines. Uncompressed text
+# blocks are stored verbatim ("raw"), or with backslashes and the carriage
+# returns that would end a comment escaped ("none"), binary and compressed
+# blocks as base85 lines
+UNESCAPE = re.compile(rb"\\\\(.)", re.DOTALL)
+UNESCAPED = {b"r": b"\\r", b"\\\\": b"\\\\"}
+
+def parse_arguments(args: List[str]) -> Dict[str, Any]:
+    "Parses the command-line arguments given to the unpacker tool"
+
+    parser = ArgumentParser(
+        prog="{{ filename }}",
+        description=\"""
+            This file is a plain-text unpacking tool. Execute it
+            to generate a folder structure of plain text files identical
+            to the structure of the directory that was used to make this.
+        \"""
+    )
+
+    parser.add_argument(
+        "members", nargs="*",
+        help="Paths of the members to extract. Defaults to every member."
+    )
+
+    parser.add_argument(
+        "-o", "--output", type=Path,
+        default=None, help="Path to generate the output. Defaults to this filename."
+    )
+
+    parser.add_argument(
+        "-l", "--list", action="store_true",
+        help="List the members of this file instead of extracting them"
+    )
+
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of threads decoding and writing members. Defaults to 1."
+    )
+
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="Check the members copied verbatim from this file against their checksums"
+    )
+
+    report = parser.add_mutually_exclusive_group()
+    report.add_argument(
+        "-q", "--quiet", dest="report", action="store_const", const="quiet",
+        help="Print nothing but errors and the summary"
+    )
+    report.add_argument(
+        "--progress", dest="report", action="store_const", const="progress",
+        help="Show a single progress line. The default when writing to a terminal."
+    )
+    report.add_argument(
+        "-v", "--verbose", dest="report", action="store_const", const="verbose",
+        help="Print every directory and file as it is created"
+    )
+
+    parser.add_argument(
+        "--summary", action="store_true",
+        help="Print a JSON summary of the extraction as the last line of the output"
+    )
+
+    parser.add_argument(
+        "--stats", nargs="?", const="table", default=None, choices=("table", "json"),
+        help="Time every phase of the extraction. Prints a table on stderr, or a JSON line with --stats json."
+    )
+
+    parser.add_argument(
+        "--memory-profile", action="store_true",
+        help="Trace memory allocations, reporting the peak of every phase, the top allocation sites and the maximum RSS"
+    )
+
+    parsed = parser.parse_args(args)
+    if parsed.report is None:
+        parsed.report = "progress" if sys.stderr.isatty() else "quiet"
+    return parsed.__dict__
+""" + unpacker_reporting + """
+def uncomment(data: bytes) -> bytes:
+    "Strips the comment sign starting every line of a block of the payload"
+
+    return data[1:].replace(b"\\n#", b"\\n")
+
+class Payload:
+    "Reads members from the payload at the end of this file, decoding each block only once"
+
+    def __init__(self, pack, index: Dict[str, Any]):
+        self.pack = pack
+        self.blocks = index["blocks"]
+        self.cached = (None, b"")
+
+    def read_block(self, block: int) -> bytes:
+        if self.cached[0] == block:
+            return self.cached[1]
+
+        offset, length, codec = self.blocks[block]
+        self.pack.seek(offset)
+        data = uncomment(self.pack.read(length))
+        # Every codec fails on damaged data with its own exception, they
+        # are reported as corrupted blocks like failed checksums are
+        try:
+            if codec == "none":
+                data = UNESCAPE.sub(lambda match: UNESCAPED[match.group(1)], data)
+            elif codec != "raw":
+                data = base64.b85decode(data.replace(b"\\n", b""))
+                if codec != "b85":
+                    # The codecs are named after the stdlib modules implementing them
+                    data = importlib.import_module(codec).decompress(data)
+        except Exception as error:
+            raise ValueError(f"Corrupted block {block}: {error}") from error
+
+        self.cached = (block, data)
+        return data
+
+    def read(self, block: int, start: int, size: int) -> bytes:
+        return self.read_block(block)[start:start + size]
+
+    def is_verbatim(self, block: int) -> bool:
+        return self.blocks[block][2] == "raw"
+
+    def copy(self, block: int, path: str):
+        "Copies a verbatim block, which holds a single member, from this file a chunk at a time"
+
+        offset, length, _ = self.blocks[block]
+        self.pack.seek(offset)
+        with open(path, "wb") as target:
+            # The comment sign of a line is dropped with the newline before
+            # it, or at the start of the next chunk when a chunk ends there
+            skip = 1
+            while length:
+                chunk = self.pack.read(min(length, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError(f"Payload ends inside block {block}")
+                length -= len(chunk)
+                target.write(chunk[skip:].replace(b"\\n#", b"\\n"))
+                skip = 1 if chunk.endswith(b"\\n") else 0
+
+def load_index(pack) -> Dict[str, Any]:
+    "Reads the index after the payload, located by the trailer on the last line of this file"
+
+    # The index ends right before the trailer, so the offsets in them only
+    # hold when this file has the size they add up to
+    size = pack.seek(0, 2)
+    pack.seek(max(size - TRAILER_SIZE, 0))
+    fields = pack.read().split()
+    if len(fields) != 3 or fields[0] != b"#packer-index" or not (fields[1] + fields[2]).isdigit() \\
+            or int(fields[1]) + int(fields[2]) + TRAILER_SIZE != size:
+        raise ValueError("its size does not match its index")
+    offset, length = fields[1:]
+    pack.seek(int(offset))
+    return json.loads(b"".join(line[1:] for line in pack.read(int(length)).splitlines()))
+
+def leaf_dirs(trie: Dict[str, Any], prefix: str = "") -> List[str]:
+    "Lists the directories of the trie in the index that have no subdirectory"
+
+    leaves = []
+    for name, children in trie.items():
+        if children:
+            leaves.extend(leaf_dirs(children, f"{prefix}{name}/"))
+        else:
+            leaves.append(f"{prefix}{name}")
+    return leaves
+
+def check_member(data: bytes, entry: Tuple[int, int, int, int, bool]):
+    "Checks the contents of a member against the size and checksum in its entry"
+
+    block, _, size, checksum, _ = entry
+    if len(data) != size or zlib.crc32(data) != checksum:
+        raise ValueError(f"Corrupted member in block {block}")
+
+def write_member(payload: Payload, path: str, entry: Tuple[int, int, int, int, bool], stats: Stats,
+                 verify: bool = False):
+    "Writes a single member of the payload to path"
+
+    # Raw members, binary files or every file of a byte-exact pack,
+    # are written as they are, text members with the platform's
+    # default encoding and line endings. Verbatim members that need no
+    # conversion are copied a chunk at a time without being decoded, and
+    # are only checked against their checksum when asked to
+    block, start, size, checksum, raw = entry
+    if payload.is_verbatim(block) and (raw or NATIVE_TEXT):
+        with stats.measure("write") as counts:
+            payload.copy(block, path)
+            counts["bytes"] = size
+        if verify:
+            with stats.measure("verify") as counts, open(path, "rb") as copied:
+                data = copied.read()
+                counts["bytes"] = len(data)
+                check_member(data, entry)
+        return
+
+    with stats.measure("decode") as counts:
+        data = payload.read(block, start, size)
+        counts["bytes"] = len(data)
+    with stats.measure("verify") as counts:
+        counts["bytes"] = len(data)
+        check_member(data, entry)
+    with stats.measure("write") as counts:
+        if raw:
+            with open(path, "wb") as target:
+                counts["bytes"] = target.write(data)
+        else:
+            with open(path, "w") as target:
+                counts["bytes"] = target.write(data.decode("utf-8"))
+
+def main(args: Dict[str, Any]):
+    output_root: Path = args["output"]
+    if output_root is None:
+        output_root = Path(__file__).parent/f"{Path(__file__).stem}"
+
+    stats = Stats(("index-load", "mkdir", "decode", "verify", "write"), args["memory_profile"])
+    # Offsets into this file no longer hold once its line endings were
+    # converted to CRLF in transfer. A pack holds no carriage return of its
+    # own, so it is then read from memory with them converted back
+    source = None
+    with stats.measure("index-load"), open(__file__, "rb") as pack:
+        try:
+            index = load_index(pack)
+        except ValueError:
+            pack.seek(0)
+            source = pack.read().replace(b"\\r\\n", b"\\n")
+            try:
+                index = load_index(io.BytesIO(source))
+            except ValueError as error:
+                sys.exit(f"Cannot unpack {Path(__file__).name}, {error}. It must be copied byte for byte.")
+    files = index["members"]
+
+    if args["list"]:
+        for name, (_, _, size, _, _) in files.items():
+            print(f"{size:>12} {name}")
+        return
+
+    members = args["members"]
+    for name in members:
+        if name not in files:
+            sys.exit(f"{name} is not a member of {Path(__file__).name}")
+
+    report = args["report"]
+    if report != "quiet":
+        print(f"Unpacking to {output_root}")
+
+    # Only directories without subdirectories are created, shallowest
+    # first, each creating its missing parents along the way. Paths are
+    # joined to the output root once and never resolved
+    root = str(output_root)
+    if members:
+        parents = sorted({name.rpartition("/")[0] for name in members}, key=lambda d: d.split("/"))
+        dirs = [d for d, after in zip(parents, parents[1:] + [""]) if not after.startswith(f"{d}/")]
+    else:
+        dirs = leaf_dirs(index["dirs"])
+
+    for d in sorted(dirs, key=lambda d: d.count("/")):
+        d = os.path.join(root, d)
+        if report == "verbose":
+            print("Created Directory:", d)
+        with stats.measure("mkdir"):
+            os.makedirs(d, exist_ok=True)
+
+    # Identical files share an entry, only the first one is decoded and
+    # the others are copied from it. Members of the same block are
+    # written by the same task so each block is decoded only once, and
+    # every thread reads through its own handle on this file
+    names = members or list(files)
+    targets = {name: os.path.join(root, name) for name in names}
+    first = {}
+    blocks = {}
+    for name in names:
+        entry = tuple(files[name])
+        if entry not in first:
+            first[entry] = name
+            blocks.setdefault(entry[0], []).append(name)
+
+    local = threading.local()
+    handles = []
+
+    def extract(name: str):
+        if not hasattr(local, "payload"):
+            local.payload = Payload(open(__file__, "rb") if source is None else io.BytesIO(source), index)
+            handles.append(local.payload.pack)
+        write_member(local.payload, targets[name], tuple(files[name]), stats, args["verify"])
+
+    def copy(name: str):
+        source = first[tuple(files[name])]
+        if source in errors:
+            raise ValueError(f"{source} could not be extracted")
+        with stats.measure("write") as counts:
+            shutil.copyfile(targets[source], targets[name])
+            counts["bytes"] = files[name][2]
+
+    # Errors are collected by member and reported in the order of the
+    # members once every task is done, whatever the number of threads
+    errors = {}
+
+    def run(task, names: List[str]) -> List[str]:
+        for name in names:
+            try:
+                task(name)
+            except (OSError, ValueError) as error:
+                errors[name] = error
+        return names
+
+    # Progress is counted on this thread as the tasks complete in order
+    progress = Progress(len(names), sum(files[name][2] for name in names), report == "progress")
+    with ThreadPoolExecutor(max_workers=max(args["jobs"], 1)) as pool:
+        try:
+            copies = [[name] for name in names if first[tuple(files[name])] != name]
+            for task, groups in ((extract, blocks.values()), (copy, copies)):
+                for group in pool.map(lambda group: run(task, group), groups):
+                    progress.advance(sum(files[name][2] for name in group), len(group))
+        finally:
+            for handle in handles:
+                handle.close()
+    progress.finish()
+
+    for name in names:
+        if name in errors:
+            print(f"Failed to extract {name}: {errors[name]}", file=sys.stderr)
+        elif report == "verbose":
+            print("Created File:", targets[name])
+
+    if args["stats"] == "json":
+        print(json.dumps(stats.to_dict()))
+    elif args["stats"] == "table" or args["memory_profile"]:
+        print(stats.format_table(), file=sys.stderr)
+
+    if args["summary"]:
+        print(json.dumps({"output": root, "failed": len(errors), **progress.summary()}))
+
+    if errors:
+        sys.exit(f"{len(errors)} members of {Path(__file__).name} could not be extracted")
+
+if __name__ == "__main__":
+    main(parse_arguments(sys.argv[1:]))
+
+# The payload below is made of comment lines, which the compiler skips
+# without building any object. Members are read from this file by byte
+# offset using the index stored in the comments that follow it.
+"""
+
+# Last line of an indexed pack, giving the offset and length of the index
+index_trailer = "#packer-index {:020d} {:020d}\n"
+
+def parse_size(text: str) -> int:
+    """Parses a size in bytes with an optional K, M or G binary suffix"""
+
+    match = re.fullmatch(r"(\d+)\s*([KMG]?)i?B?", text.strip(), re.IGNORECASE)
+    if match is None:
+        raise ArgumentTypeError(f"invalid size: '{text}'")
+    return int(match.group(1)) * 1024 ** " KMG".index(match.group(2).upper() or " ")
+
 def parse_arguments(args: List[str]) -> Dict[str, Any]:
     """Parses the command-line arguments given to the packer tool"""
 
@@ -110,53 +836,1317 @@ def parse_arguments(args: List[str]) -> Dict[str, Any]:
     )
 
     parser.add_argument(
-        "-i", "--ignore", default=[], nargs='+', help="Path components that should be ignored. For example, '__pycache__'"
+        "-i", "--ignore", default=[], nargs='+',
+        help="""gitignore-style patterns that should be ignored. For example, 
+                '__pycache__', '*.pyc' or '/build/'. Patterns are relative
+                to the packed directory."""
+    )
+
+    parser.add_argument(
+        "-f", "--format", choices=PACK_FORMATS, default="indexed",
+        help="""Layout of the generated file. 'indexed', the default, lets the
+                unpacker list and extract single members without loading
+                the rest. 'legacy' stores every file in a dict literal."""
+    )
+
+    parser.add_argument(
+        "-c", "--compress", choices=COMPRESSORS, default="none",
+        help="""Compress each member and store it as base85 text. Only
+                available with the indexed format. Defaults to 'none'."""
+    )
+
+    parser.add_argument(
+        "-b", "--block-size", type=parse_size, default=0,
+        help="""Compress consecutive small files together in solid blocks
+                of about this size, for example '1M'. Extracting a file
+                only decompresses its own block. Requires --compress."""
+    )
+
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of threads used to read and encode files. Defaults to 1."
+    )
+
+    parser.add_argument(
+        "--cache", type=Path, default=None,
+        help="""Directory of a persistent cache. Files that did not change
+                since the last run are reused without being read."""
+    )
+
+    parser.add_argument(
+        "--cache-size", type=parse_size, default=DEFAULT_CACHE_SIZE,
+        help="Maximum size of the cache directory, for example '512M'. Defaults to 1G."
+    )
+
+    parser.add_argument(
+        "--byte-exact", action="store_true",
+        help="""Store and extract every file as raw bytes, keeping line
+                endings and encodings. Only available with the indexed format."""
+    )
+
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Rewrite the output even if it is up to date with the directory"
+    )
+
+    parser.add_argument(
+        "--no-ignore-files", dest="ignore_files", action="store_false",
+        help="Do not read rules from .gitignore and .packerignore files"
+    )
+
+    report = parser.add_mutually_exclusive_group()
+    report.add_argument(
+        "-q", "--quiet", dest="report", action="store_const", const="quiet",
+        help="Print nothing but errors and the summary"
+    )
+    report.add_argument(
+        "--progress", dest="report", action="store_const", const="progress",
+        help="""Show a single progress line with the files, bytes, throughput
+                and remaining time. The default when writing to a terminal."""
+    )
+    report.add_argument(
+        "-v", "--verbose", dest="report", action="store_const", const="verbose",
+        help="Print every file and directory as it is packed"
+    )
+
+    parser.add_argument(
+        "--summary", action="store_true",
+        help="Print a JSON summary of the run as the last line of the output"
     )
 
-    return parser.parse_args(args).__dict__
+    parser.add_argument(
+        "--stats", nargs="?", const="table", default=None, choices=("table", "json"),
+        help="""Time every phase of the run. Prints a table on stderr, or a
+                JSON line on stdout with --stats json."""
+    )
 
-def generate_packed_file(inp: Path, out: Path, ignore_list: List[str], root_dir: Path, print_output=True) -> bool:
+    parser.add_argument(
+        "--memory-profile", action="store_true",
+        help="""Trace memory allocations, reporting the peak of every phase,
+                the allocation sites at the highest peak and the maximum
+                resident set size. Slows the run down."""
+    )
+
+    parser.add_argument(
+        "--trace", type=Path, default=None,
+        help="""Record a span for every phase of every file and block, on
+                the thread that ran it, into a Chrome trace event file
+                that Perfetto or chrome://tracing can open"""
+    )
+
+    parsed = parser.parse_args(args)
+    if parsed.report is None:
+        parsed.report = "progress" if sys.stderr.isatty() else "quiet"
+    if parsed.format == "legacy" and parsed.compress != "none":
+        parser.error("--compress requires the indexed format")
+    if parsed.format == "legacy" and parsed.byte_exact:
+        parser.error("--byte-exact requires the indexed format")
+    if parsed.format == "legacy" and parsed.cache is not None:
+        parser.error("--cache requires the indexed format")
+    if parsed.block_size and parsed.compress == "none":
+        parser.error("--block-size requires --compress")
+
+    return parsed.__dict__
+
+def format_size(size: float) -> str:
+    """Formats a number of bytes with a binary unit"""
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+class Progress:
     """
-    Packs an entire directory of plain text files into one single
-    python file
+    Counts the files and bytes processed so far. When `show` is set, a
+    single line with the counts, throughput and remaining time is
+    refreshed on `stream` at most every `interval` seconds, so the
+    output costs the same whatever the number of files.
     """
 
-    # out.write_text()
+    def __init__(self, total_files: int, total_bytes: int, show: bool = False,
+                 stream=sys.stderr, interval: float = PROGRESS_INTERVAL):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.show = show
+        self.stream = stream
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.shown = self.start
 
-    files = []
-    dirs = [inp.name]
+    def advance(self, size: int, files: int = 1):
+        """Counts files that were processed, refreshing the line when it is due"""
 
-    # inp.mkdir(parents=True)
-    for item in inp.rglob("*"):
-        # Skip any values found in the ignore list
-        skip = False
-        for ignored in ignore_list:
-            if ignored in str(item):
-                skip = True
-                break
-        if skip:
+        self.files += files
+        self.bytes += size
+        now = time.monotonic()
+        if self.show and now - self.shown >= self.interval:
+            self.shown = now
+            self.refresh(now)
+
+    def refresh(self, now: float):
+        elapsed = now - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total_bytes - self.bytes, 0) / rate if rate else 0.0
+        self.stream.write(
+            f"\r{self.files}/{self.total_files} files"
+            f"  {format_size(self.bytes)}/{format_size(self.total_bytes)}"
+            f"  {format_size(rate)}/s  ETA {remaining:.0f}s\033[K"
+        )
+        self.stream.flush()
+
+    def finish(self):
+        """Shows the final counts and ends the progress line"""
+
+        if self.show:
+            self.refresh(time.monotonic())
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the counts and timing of the run so far"""
+
+        elapsed = time.monotonic() - self.start
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(elapsed, 6),
+            "bytes_per_second": round(self.bytes / elapsed) if elapsed > 0 else 0,
+        }
+
+class Stats:
+    """
+    Wall time, CPU time, items and bytes of each phase of a run. A phase
+    measured inside another one on the same thread is not counted in
+    the outer phase, so the phases of a thread never overlap. With
+    several jobs, the times of a phase add up over its threads and can
+    exceed the wall time of the run.
+
+    With `trace`, every measured span is also kept as a Chrome trace
+    event, labelled with what it processed, for `write_trace`.
+
+    With `memory`, allocations are traced with tracemalloc. The peak of
+    the traced memory between two span boundaries counts towards every
+    phase running in between, on any thread, so each phase gets the
+    highest peak reached while it ran. The allocation sites are
+    snapshotted whenever the peak grows by MEMORY_SNAPSHOT_GROWTH.
+    """
+
+    def __init__(self, phases: Iterable[str] = STATS_PHASES, trace: bool = False, memory: bool = False):
+        self.phases = {phase: self._new_record() for phase in phases}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.events = [] if trace else None
+        self.threads = {}
+
+        self.memory = memory
+        self.running = {}
+        self.peak = 0
+        self.snapshot_peak = 0
+        self.top_sites = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @staticmethod
+    def _new_record() -> Dict[str, Any]:
+        return {"wall": 0.0, "cpu": 0.0, "items": 0, "bytes": 0, "peak_traced": 0}
+
+    @contextlib.contextmanager
+    def measure(self, phase: str, items: int = 1, label: Optional[str] = None) -> Iterator[Dict[str, int]]:
+        """
+        Times the body of a with statement as `phase`. The body can add
+        to the yielded "items" and "bytes" counts. The `label` names the
+        file or block in the trace.
+        """
+
+        counts = {"items": items, "bytes": 0}
+        stack = self.local.__dict__.setdefault("stack", [])
+        if stack:
+            self._charge(stack[-1])
+        if self.memory:
+            self._sample(enter=phase)
+        begin = time.perf_counter()
+        stack.append([phase, begin, time.thread_time()])
+        try:
+            yield counts
+        finally:
+            self._charge(stack.pop(), counts)
+            if self.memory:
+                self._sample(leave=phase)
+            if stack:
+                stack[-1][1:] = [time.perf_counter(), time.thread_time()]
+            if self.events is not None:
+                self._record(phase, begin, label, counts)
+
+    def _sample(self, enter: Optional[str] = None, leave: Optional[str] = None):
+        # Charges the peak since the last boundary to the running phases,
+        # then starts a new interval with the phase entering or leaving
+        with self.lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            for phase in self.running:
+                record = self.phases.setdefault(phase, self._new_record())
+                record["peak_traced"] = max(record["peak_traced"], peak)
+            self.peak = max(self.peak, peak)
+
+            if peak > self.snapshot_peak * (1 + MEMORY_SNAPSHOT_GROWTH):
+                self.snapshot_peak = peak
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                ])
+                self.top_sites = [
+                    {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     "size": stat.size, "count": stat.count}
+                    for stat in snapshot.statistics("lineno")[:MEMORY_TOP_SITES]
+                ]
+            tracemalloc.reset_peak()
+
+            if enter is not None:
+                self.running[enter] = self.running.get(enter, 0) + 1
+            if leave is not None:
+                self.running[leave] -= 1
+                if not self.running[leave]:
+                    del self.running[leave]
+
+    def _record(self, phase: str, begin: float, label: Optional[str], counts: Dict[str, int]):
+        thread = threading.current_thread()
+        event = {
+            "name": label or phase, "cat": phase, "ph": "X",
+            "ts": round((begin - self.start) * 1e6, 3),
+            "dur": round((time.perf_counter() - begin) * 1e6, 3),
+            "pid": os.getpid(), "tid": thread.ident,
+            "args": counts,
+        }
+        with self.lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    def _charge(self, frame: List[Any], counts: Optional[Dict[str, int]] = None):
+        phase, wall, cpu = frame
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        with self.lock:
+            record = self.phases.setdefault(phase, self._new_record())
+            record["wall"] += wall
+            record["cpu"] += cpu
+            if counts is not None:
+                record["items"] += counts["items"]
+                record["bytes"] += counts["bytes"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the totals of the run and of every phase, and the memory profile if there is one"""
+
+        totals = {
+            "wall": round(time.perf_counter() - self.start, 6),
+            "cpu": round(time.process_time() - self.cpu_start, 6),
+            "phases": {
+                phase: {**record, "wall": round(record["wall"], 6), "cpu": round(record["cpu"], 6)}
+                for phase, record in self.phases.items()
+            },
+        }
+        if not self.memory:
+            for record in totals["phases"].values():
+                del record["peak_traced"]
+            return totals
+
+        self._sample()
+        totals["memory"] = {
+            "peak_traced": self.peak,
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+                       if resource is not None else None,
+            "top_sites": self.top_sites,
+        }
+        return totals
+
+    def format_table(self) -> str:
+        """Formats the phases as a plain text table"""
+
+        totals = self.to_dict()
+        peak = f"{'peak':>12}" if self.memory else ""
+        lines = [f"{'phase':<12}{'wall s':>10}{'cpu s':>10}{'items':>10}{'bytes':>14}{peak}"]
+        for phase, record in totals["phases"].items():
+            peak = f"{format_size(record['peak_traced']):>12}" if self.memory else ""
+            lines.append(
+                f"{phase:<12}{record['wall']:>10.3f}{record['cpu']:>10.3f}"
+                f"{record['items']:>10}{record['bytes']:>14}{peak}"
+            )
+        lines.append(f"{'total':<12}{totals['wall']:>10.3f}{totals['cpu']:>10.3f}")
+
+        if self.memory:
+            memory = totals["memory"]
+            lines.append(f"peak traced memory {format_size(memory['peak_traced'])}")
+            if memory["max_rss"] is not None:
+                lines.append(f"max resident set size {format_size(memory['max_rss'])}")
+            lines.append("top allocation sites at the peak:")
+            for site in memory["top_sites"]:
+                lines.append(f"{format_size(site['size']):>12}{site['count']:>10}  {site['site']}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: Path):
+        """Writes the recorded spans as a Chrome trace event file, naming every thread"""
+
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self.threads.items()
+        ]
+        with Path(path).open("w") as trace:
+            json.dump({"traceEvents": events + (self.events or []), "displayTimeUnit": "ms"}, trace)
+
+def measure(stats: Optional[Stats], phase: str, items: int = 1,
+            label: Optional[str] = None) -> ContextManager[Dict[str, int]]:
+    """Times a phase with `stats`, or does nothing when it is None"""
+
+    if stats is None:
+        return contextlib.nullcontext({"items": items, "bytes": 0})
+    return stats.measure(phase, items, label)
+
+def _translate_glob(segment: str) -> str:
+    """Translates a single path segment of a glob into a regular expression"""
+
+    regex = []
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "\\" and i < len(segment):
+            regex.append(re.escape(segment[i]))
+            i += 1
+        elif char == "[":
+            end = segment.find("]", i + 1)
+            if end == -1:
+                regex.append(re.escape(char))
+                continue
+            body = segment[i:end]
+            i = end + 1
+            negated = body[:1] in ("!", "^")
+            if negated:
+                body = body[1:]
+            body = body.replace("\\", "\\\\")
+            regex.append(f"[^/{body}]" if negated else f"[{body}]")
+        else:
+            regex.append(re.escape(char))
+
+    return "".join(regex)
+
+def translate_ignore_pattern(line: str, base: str = "") -> Optional[Tuple[str, bool, bool]]:
+    """
+    Translates one gitignore-style line into a (regex, negated, dir_only)
+    tuple. The regex matches paths relative to the packed directory,
+    `base` being the directory the rule was read from. Returns None for
+    blank lines and comments.
+    """
+
+    line = line.rstrip("\n\r")
+    # Trailing spaces are ignored unless they are escaped
+    while line.endswith(" ") and not line.endswith("\\ "):
+        line = line[:-1]
+    if not line or line.startswith("#"):
+        return None
+
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    # A slash anywhere but the end anchors the pattern to its directory
+    anchored = "/" in line
+    line = line.lstrip("/")
+
+    regex = []
+    parts = line.split("/")
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+        if part == "**":
+            regex.append(".*" if last else "(?:.*/)?")
+        else:
+            regex.append(_translate_glob(part) + ("" if last else "/"))
+
+    prefix = re.escape(base + "/") if base else ""
+    if not anchored:
+        prefix += "(?:.*/)?"
+
+    return prefix + "".join(regex), negated, dir_only
+
+class IgnoreMatcher:
+    """
+    Matches paths relative to the packed directory against gitignore-style
+    rules. All rules that apply to a directory are compiled into one
+    combined regular expression, so every entry costs a single match
+    regardless of the number of patterns. Like git, the last matching
+    rule wins and a `!` rule re-includes a path.
+    """
+
+    def __init__(self, rules: Iterable[Tuple[str, bool, bool]] = (), ignore_files: Iterable[str] = IGNORE_FILES):
+        self.rules = list(rules)
+        self.ignore_files = tuple(ignore_files)
+        self._dir_regex = self._compile(self.rules)
+        self._file_regex = self._compile([rule for rule in self.rules if not rule[2]])
+
+    @staticmethod
+    def _compile(rules: List[Tuple[str, bool, bool]]):
+        if not rules:
+            return None
+
+        # Alternatives are tried in order, so listing the rules backwards
+        # makes the first successful alternative the last matching rule
+        return re.compile("(?s)" + "|".join(
+            f"(?P<{'n' if negated else 'i'}{index}>{regex})"
+            for index, (regex, negated, _) in reversed(list(enumerate(rules)))
+        ))
+
+    @classmethod
+    def from_patterns(cls, patterns: Iterable[str], ignore_files: Iterable[str] = IGNORE_FILES) -> "IgnoreMatcher":
+        """Creates a matcher from patterns given relative to the packed directory"""
+
+        rules = (translate_ignore_pattern(pattern) for pattern in patterns)
+        return cls([rule for rule in rules if rule is not None], ignore_files)
+
+    def for_directory(self, path: str, rel: str) -> "IgnoreMatcher":
+        """
+        Returns the matcher that applies inside the directory at `path`,
+        extended with the rules of its ignore files. `rel` is the
+        directory relative to the packed directory.
+        """
+
+        # Like git, ignore files are read as UTF-8 whatever the locale.
+        # Those that cannot be read, like directories named after them,
+        # are skipped as unreadable directories are
+        rules = []
+        for name in self.ignore_files:
+            try:
+                with open(os.path.join(path, name), encoding="utf-8", errors="replace") as ignore_file:
+                    lines = ignore_file.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                rule = translate_ignore_pattern(line, rel)
+                if rule is not None:
+                    rules.append(rule)
+
+        if not rules:
+            return self
+        return IgnoreMatcher(self.rules + rules, self.ignore_files)
+
+    def is_ignored(self, rel: str, is_dir: bool) -> bool:
+        """Checks whether a path relative to the packed directory is ignored"""
+
+        regex = self._dir_regex if is_dir else self._file_regex
+        if regex is None:
+            return False
+
+        match = regex.fullmatch(rel)
+        return match is not None and match.lastgroup[0] == "i"
+
+def walk_tree(top: Path, matcher: IgnoreMatcher, stats: Optional[Stats] = None) -> Iterator[os.DirEntry]:
+    """
+    Walks a directory tree with os.scandir, yielding every entry that
+    is not ignored. Each directory's entries are yielded before its
+    subdirectories are visited. Ignored directories are pruned before
+    descending, so their contents are never listed.
+
+    Like `Path.rglob`, symlinks to directories are yielded but never
+    descended into, and directories that cannot be listed are skipped.
+    """
+
+    stack = [(str(top), "", matcher.for_directory(str(top), ""))]
+    while stack:
+        path, rel, matcher = stack.pop()
+        try:
+            with measure(stats, "walk", label=path) as counts, os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+                counts["items"] = len(entries)
+        except PermissionError:
             continue
 
-        # Add dirs
-        if item.is_dir():
-            dirs.append(item.relative_to(root_dir))
+        subdirs = []
+        for entry in entries:
+            entry_rel = f"{rel}/{entry.name}" if rel else entry.name
+
+            # DirEntry caches the type from the directory listing,
+            # so this does not cost an extra stat on most platforms
+            with measure(stats, "filter", label=entry_rel):
+                is_dir = entry.is_dir()
+                if matcher.is_ignored(entry_rel, is_dir):
+                    continue
+
+                if is_dir and not entry.is_symlink():
+                    subdirs.append((entry.path, entry_rel, matcher.for_directory(entry.path, entry_rel)))
+            yield entry
+
+        # Reversed so that the stack pops them in sorted order
+        stack.extend(reversed(subdirs))
+
+def make_dir_trie(dirs: Iterable[Path]) -> Dict[str, Any]:
+    """
+    Builds a trie of relative directory paths, as nested dicts keyed by
+    path segment. Chains of directories with a single child are merged
+    into one key joined with "/", so deep trees stay compact.
+    """
+
+    trie = {}
+    for d in dirs:
+        node = trie
+        for part in Path(d).parts:
+            node = node.setdefault(part, {})
+
+    def compress(node: Dict[str, Any]) -> Dict[str, Any]:
+        merged = {}
+        for name, children in node.items():
+            children = compress(children)
+            if len(children) == 1:
+                (child, children), = children.items()
+                name = f"{name}/{child}"
+            merged[name] = children
+        return merged
+
+    return compress(trie)
+
+def iter_leaf_dirs(trie: Dict[str, Any], prefix: str = "") -> Iterator[str]:
+    """Yields the paths of the directories of a trie that have no subdirectory"""
+
+    for name, children in trie.items():
+        if children:
+            yield from iter_leaf_dirs(children, f"{prefix}{name}/")
+        else:
+            yield f"{prefix}{name}"
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+def map_ordered(func: Callable[[T], R], items: Iterable[T], jobs: int = 1) -> Iterator[R]:
+    """
+    Maps `func` over `items` on a pool of `jobs` threads, yielding the
+    results in the same order as the items. At most a bounded window of
+    items is in flight at once, so results that are not consumed yet
+    do not pile up in memory.
+    """
+
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    window = jobs * JOBS_WINDOW_FACTOR
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def encode_base85(data: bytes) -> bytes:
+    """Encodes data as base85 text wrapped to B85_LINE_WIDTH"""
+
+    encoded = base64.b85encode(data)
+    return b"\n".join(encoded[i:i + B85_LINE_WIDTH] for i in range(0, len(encoded), B85_LINE_WIDTH))
+
+def is_binary(sample: bytes, encoding: Optional[str] = None) -> bool:
+    """
+    Guesses whether a file is binary from a sample of its first bytes,
+    which is binary if it contains a NUL byte or cannot be decoded with
+    `encoding`, by default the encoding used to read text files
+    """
+
+    if b"\0" in sample:
+        return True
+
+    try:
+        # Incremental, so a character cut at the end of the sample is fine
+        codecs.getincrementaldecoder(encoding or locale.getpreferredencoding(False))().decode(sample)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+def read_file_data(item: Path, exact: bool = False) -> Tuple[bytes, bool]:
+    """
+    Reads a file, returning its contents and whether it is binary. Only
+    the first SNIFF_SIZE bytes are used to classify it. Text files are
+    decoded like `Path.read_text` does and returned as UTF-8, binary
+    files are returned as they are.
+
+    With `exact`, every file is returned as it is, and only files that
+    are valid UTF-8 count as text.
+    """
+
+    data = item.read_bytes()
+    encoding = "utf-8" if exact else locale.getpreferredencoding(False)
+    if is_binary(data[:SNIFF_SIZE], encoding):
+        return data, True
+
+    try:
+        text = data.decode(encoding)
+    except UnicodeDecodeError:
+        return data, True
+
+    if exact:
+        return data, False
+    return text.replace("\r\n", "\n").replace("\r", "\n").encode("utf-8"), False
+
+# Characters escaped inside a triple-quoted literal using `quote`: every
+# backslash, and every quote that starts a run of three or that is part
+# of a run at the very end, where it would merge with the closing quotes
+LITERAL_ESCAPES = {
+    quote: re.compile(r'\\|{0}(?={0}{0}|{0}*\Z)'.format(quote))
+    for quote in ('"', "'")
+}
+
+# Characters escaped inside a text block of an indexed pack: backslashes,
+# and carriage returns, which would end the comment line holding them
+PAYLOAD_ESCAPES = re.compile(rb"[\\\r]")
+
+def escape_payload(data: bytes) -> bytes:
+    """Escapes a text block for the payload of an indexed pack in a single pass"""
+
+    return PAYLOAD_ESCAPES.sub(lambda match: b"\\r" if match.group() == b"\r" else b"\\\\", data)
+
+def comment_lines(data: bytes) -> bytes:
+    """Starts every line of an encoded block with "#", so the compiler skips it as a comment"""
+
+    return b"#" + data.replace(b"\n", b"\n#")
+
+def fits_raw_literal(text: str, quote: str) -> bool:
+    """Checks whether text can be written verbatim inside a raw triple-quoted literal"""
+
+    trailing_backslashes = len(text) - len(text.rstrip("\\"))
+    return (
+        quote * 3 not in text and not text.endswith(quote)
+        and trailing_backslashes % 2 == 0 and "\r" not in text
+    )
+
+def make_literal(data: bytes, binary: bool) -> str:
+    """
+    Picks the cheapest safe Python literal for a file's contents. Text
+    is written verbatim in a raw triple-quoted string when it allows it,
+    otherwise escaped in the triple-quoted string needing the fewest
+    escapes. Binary files, and text for which escaping would cost more
+    than base85, are written as a base85 block.
+    """
+
+    encoded_size = len(data) * 5 // 4
+    if not binary and b"\0" not in data:
+        text = data.decode("utf-8")
+        for quote in ('"', "'"):
+            if fits_raw_literal(text, quote):
+                return f"r{quote * 3}{text}{quote * 3}"
+
+        quote = '"' if text.count('"""') <= text.count("'''") else "'"
+        escaped = LITERAL_ESCAPES[quote].sub(r"\\\g<0>", text)
+        if len(escaped.encode("utf-8")) <= encoded_size:
+            return f"{quote * 3}{escaped}{quote * 3}"
+
+    block = encode_base85(data).decode("ascii")
+    literal = f'b85decode("""{block}""".replace("\\n", ""))'
+    return literal if binary else f'{literal}.decode("utf-8")'
+
+def read_packed_file(item: Path, root_dir: Path, stats: Optional[Stats] = None) -> Dict[str, str]:
+    """Reads a single file and makes its literal for the unpacker template"""
+
+    with measure(stats, "read", label=str(item)) as counts:
+        data, binary = read_file_data(item)
+        counts["bytes"] = len(data)
+    with measure(stats, "encode", label=str(item)) as counts:
+        literal = make_literal(data, binary)
+        counts["bytes"] = len(literal)
+    return {
+        'name': str(item.relative_to(root_dir)),
+        'literal': literal,
+        'size': len(data),
+    }
+
+def iter_packed_files(items: List[Path], root_dir: Path, jobs: int = 1,
+                      stats: Optional[Stats] = None) -> Iterator[Dict[str, str]]:
+    """
+    Lazily reads and escapes each file so that only a bounded number
+    of files' text is held in memory at a time. With more than one job
+    the files are read on a thread pool but still yielded in order.
+    """
+
+    return map_ordered(lambda item: read_packed_file(item, root_dir, stats), items, jobs)
+
+class PackCache:
+    """
+    Persistent cache for repacking the same tree. A manifest records the
+    size, mtime and inode of every file read along with its digest and
+    checksum, so unchanged files are recognised without being read.
+    Encoded blocks are stored under a key made of the codec and the
+    digests of their contents, and are evicted least recently used
+    first once the cache grows past `max_size` bytes.
+    """
+
+    def __init__(self, path: Path, max_size: int = DEFAULT_CACHE_SIZE):
+        self.path = Path(path)
+        self.blocks = self.path/"blocks"
+        self.max_size = max_size
+        self.seen = set()
+        self.lock = threading.Lock()
+
+        self.blocks.mkdir(parents=True, exist_ok=True)
+        try:
+            with (self.path/"manifest.json").open() as manifest:
+                self.files = json.load(manifest)["files"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self.files = {}
+
+    def lookup(self, item: Path, exact: bool = False) -> Tuple[os.stat_result, Optional[Tuple[bytes, int, int, bool]]]:
+        """
+        Stats a file and returns the stat along with the digest, checksum,
+        size and binary flag recorded for it when read in the same mode,
+        or None if it changed since
+        """
+
+        stat = os.stat(item)
+        key = os.path.abspath(item)
+        with self.lock:
+            self.seen.add(key)
+            entry = self.files.get(key)
+
+        if entry is None or entry[:3] != [stat.st_size, stat.st_mtime_ns, stat.st_ino] or entry[7:] != [exact]:
+            return stat, None
+        return stat, (bytes.fromhex(entry[3]), entry[4], entry[5], entry[6])
+
+    def record(self, item: Path, stat: os.stat_result, digest: bytes, checksum: int, size: int, binary: bool,
+               exact: bool = False):
+        """Records the digest, checksum, size and binary flag read from a file with the given stat"""
+
+        with self.lock:
+            self.files[os.path.abspath(item)] = [
+                stat.st_size, stat.st_mtime_ns, stat.st_ino, digest.hex(), checksum, size, binary, exact
+            ]
+
+    @staticmethod
+    def block_key(codec: str, digests: List[bytes]) -> str:
+        """Returns the key of the block encoding the given contents with a codec"""
+
+        prefix = f"{CACHE_BLOCK_VERSION}:{codec}".encode("ascii")
+        return hashlib.sha256(prefix + b"".join(digests)).hexdigest()
+
+    def load_block(self, key: str) -> Optional[Tuple[str, bytes]]:
+        """Returns the codec and data of a cached block, marking it as recently used, or None"""
+
+        path = self.blocks/key
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)
+        codec, _, data = data.partition(b"\n")
+        return codec.decode("ascii"), data
+
+    def store_block(self, key: str, codec: str, data: bytes):
+        """Stores an encoded block after a line naming its codec, replacing the file atomically"""
+
+        temp = self.blocks/f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with temp.open("wb") as block:
+            block.write(codec.encode("ascii") + b"\n")
+            block.write(data)
+        os.replace(temp, self.blocks/key)
+
+    def save(self, root: Path):
+        """
+        Writes the manifest, forgetting files under `root` that were not
+        seen in this run, and evicts the least recently used blocks
+        until the cache fits in `max_size`
+        """
+
+        prefix = os.path.join(os.path.abspath(root), "")
+        files = {
+            key: entry for key, entry in self.files.items()
+            if key in self.seen or not key.startswith(prefix)
+        }
+
+        temp = self.path/f"manifest.json.{os.getpid()}.tmp"
+        with temp.open("w") as manifest:
+            json.dump({"files": files}, manifest, separators=(",", ":"))
+        os.replace(temp, self.path/"manifest.json")
+
+        with os.scandir(self.blocks) as it:
+            blocks = sorted(
+                ((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in it),
+                reverse=True
+            )
+
+        total = 0
+        for _, size, path in blocks:
+            total += size
+            if total > self.max_size:
+                os.remove(path)
+
+def read_indexed_member(item: Path, cache: Optional[PackCache] = None, exact: bool = False,
+                        codec: str = "none", stats: Optional[Stats] = None) -> Tuple[Optional[bytes], bytes, int, int, bool]:
+    """
+    Reads a single file for the indexed format, returning its contents,
+    the digest used to store identical files only once, its checksum,
+    its size and whether it is binary. When the cache knows the file is
+    unchanged, it is not read and None is returned in place of the
+    contents.
+
+    With `exact` the file is read as it is. Compressed blocks can hold
+    any bytes, so the file is then not even checked for being text.
+    """
+
+    if cache is not None:
+        stat, entry = cache.lookup(item, exact)
+        if entry is not None:
+            return (None,) + entry
+
+    with measure(stats, "read", label=str(item)) as counts:
+        if exact and codec != "none":
+            data, binary = item.read_bytes(), True
+        else:
+            data, binary = read_file_data(item, exact)
+        counts["bytes"] = len(data)
+
+    with measure(stats, "hash", label=str(item)) as counts:
+        digest = hashlib.sha256(data).digest()
+        checksum = zlib.crc32(data)
+        counts["bytes"] = len(data)
+    if cache is not None:
+        cache.record(item, stat, digest, checksum, len(data), binary, exact)
+    return data, digest, checksum, len(data), binary
+
+def encode_indexed_block(group: List[Tuple[Path, Optional[bytes], bytes, bool]], codec: str = "none",
+                         cache: Optional[PackCache] = None, exact: bool = False,
+                         stats: Optional[Stats] = None) -> Tuple[str, bytes]:
+    """
+    Encodes a group of (file, contents, digest, binary) into the block
+    stored in the payload, returning the codec of the block and its data.
+
+    Every line of a block is a comment. Uncompressed groups hold a
+    single file. Text without carriage returns is stored verbatim in a
+    "raw" block, other text is escaped in a "none" block and binary
+    files are stored as plain base85 text in a "b85" block. Compressed
+    blocks are stored as compressed base85 text. Cached blocks are
+    reused as they are, files whose contents were skipped by the cache
+    are only read on a miss.
+    """
+
+    if cache is not None:
+        key = cache.block_key(codec, [digest for _, _, digest, _ in group])
+        cached = cache.load_block(key)
+        if cached is not None:
+            return cached
+
+    label = str(group[0][0]) if len(group) == 1 else f"{group[0][0]} and {len(group) - 1} more"
+    missing = [item for item, contents, _, _ in group if contents is None]
+    with measure(stats, "read", len(missing), label) as counts:
+        reread = {item: read_file_data(item, exact)[0] for item in missing}
+        counts["bytes"] = sum(map(len, reread.values()))
+    data = b"".join(
+        contents if contents is not None else reread[item]
+        for item, contents, _, _ in group
+    )
+
+    if codec != "none":
+        with measure(stats, "compress", label=label) as counts:
+            data = COMPRESSORS[codec](data)
+            counts["bytes"] = len(data)
+
+    with measure(stats, "encode", label=label) as counts:
+        if codec != "none":
+            block_codec, stored = codec, encode_base85(data)
+        elif group[0][3] or b"\0" in data:
+            block_codec, stored = "b85", encode_base85(data)
+        elif b"\r" not in data:
+            block_codec, stored = "raw", data
         else:
-            files.append({
-                'name': str(item.relative_to(root_dir)),
-                'text': item.read_text().replace('\\','\\\\').replace('"', '\\"')
-            })
-
-        # Print the value
-        print( item.relative_to(root_dir) )
-
-    template = jinja2.Template( unpacker_template )
-    out.write_text(
-        template.render({
-            "filename": out.name,
-            "files": files,
-            "dirs": dirs,
+            block_codec, stored = "none", escape_payload(data)
+        stored = comment_lines(stored)
+        counts["bytes"] = len(stored)
+
+    if cache is not None:
+        cache.store_block(key, block_codec, stored)
+    return block_codec, stored
+
+def output_name(out: Union[Path, BinaryIO]) -> str:
+    """Returns the file name of an output path or stream, used as the unpacker's name"""
+
+    name = out if isinstance(out, (str, os.PathLike)) else getattr(out, "name", None)
+    return Path(name).name if isinstance(name, (str, os.PathLike)) else DEFAULT_PACK_NAME
+
+@contextlib.contextmanager
+def open_output(out: Union[Path, BinaryIO]) -> Iterator[BinaryIO]:
+    """
+    Opens an output path for buffered binary writing, or passes an open
+    binary stream through, leaving it open. A path is written to a
+    temporary file beside it that only replaces it once it is complete
+    """
+
+    if not isinstance(out, (str, os.PathLike)):
+        yield out
+        return
+
+    # A pack left incomplete would still start with a valid fingerprint,
+    # and be reported as up to date by the next run
+    temp = f"{os.fspath(out)}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "wb", buffering=WRITE_BUFFER_SIZE) as stream:
+            yield stream
+        if os.path.exists(out):
+            os.chmod(temp, os.stat(out).st_mode & 0o7777)
+        os.replace(temp, out)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp)
+        raise
+
+def write_legacy_pack(out: Union[Path, BinaryIO], files: List[Path], dirs: List[Path], root_dir: Path, jobs: int = 1,
+                      fingerprint: str = "", progress: Optional[Progress] = None, stats: Optional[Stats] = None,
+                      filename: Optional[str] = None) -> int:
+    """
+    Streams the files into a dict literal inside the unpacker, written to
+    a path or a binary stream. Returns the number of bytes written.
+    """
+
+    def iter_files() -> Iterator[Dict[str, str]]:
+        for packed in iter_packed_files(files, root_dir, jobs, stats):
+            if progress is not None:
+                progress.advance(packed["size"])
+            yield packed
+
+    with measure(stats, "render"):
+        template = jinja2.Template( unpacker_template )
+        chunks = template.stream({
+            "fingerprint": fingerprint,
+            "filename": filename or output_name(out),
+            "files": iter_files(),
+            "dirs": list(iter_leaf_dirs(make_dir_trie(dirs))),
+            **UNPACKER_SETTINGS,
+        })
+
+    # Rendering pulls the files as it goes, reading them is timed on its own
+    written = 0
+    with open_output(out) as stream:
+        while True:
+            with measure(stats, "render", 0):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with measure(stats, "write") as counts:
+                counts["bytes"] = stream.write(chunk.encode("utf-8"))
+            written += counts["bytes"]
+    return written
+
+def write_indexed_pack(out: Union[Path, BinaryIO], files: List[Path], dirs: List[Path], root_dir: Path, jobs: int = 1,
+                       codec: str = "none", block_size: int = 0, cache: Optional[PackCache] = None,
+                       fingerprint: str = "", exact: bool = False, progress: Optional[Progress] = None,
+                       stats: Optional[Stats] = None, filename: Optional[str] = None) -> int:
+    """
+    Streams the files into a payload of comment lines at the end of the
+    unpacker, followed by an index of each member's block, position,
+    size and checksum, and of each block's byte offset and length.
+
+    Files with identical contents are stored once and share an index
+    entry. With a `block_size`, consecutive small files are compressed
+    together in solid blocks, so extracting one file only decodes its
+    own block. The index is JSON, wrapped in comment lines and located
+    through a fixed-size trailer. Compiling the unpacker only scans past
+    the payload and the index, without building any object for them.
+    With a `cache`, unchanged files and blocks from previous runs are
+    reused.
+
+    With `exact`, every file is stored as the bytes read from disk and
+    written back as they are, keeping line endings and encodings.
+
+    Returns the number of bytes written.
+    """
+
+    members = {}
+    blocks = []
+
+    def iter_groups() -> Iterator[List[Tuple[Path, Optional[bytes], bytes, bool]]]:
+        # Groups the unique contents into blocks of about block_size
+        # bytes. A block size of 0 puts every file in its own block, as
+        # does leaving the pack uncompressed so each block can be stored
+        # in the cheapest form for its file
+        blobs = {}
+        group = []
+        block = 0
+        start = 0
+        read = map_ordered(lambda item: read_indexed_member(item, cache, exact, codec, stats), files, jobs)
+        for item, (data, digest, checksum, size, binary) in zip(files, read):
+            if digest not in blobs:
+                blobs[digest] = (block, start, size, checksum, binary or exact)
+                group.append((item, data, digest, binary))
+                start += size
+            members[item.relative_to(root_dir).as_posix()] = blobs[digest]
+            if progress is not None:
+                progress.advance(size)
+
+            if group and (start >= block_size or codec == "none"):
+                yield group
+                group = []
+                block += 1
+                start = 0
+
+        if group:
+            yield group
+
+    with measure(stats, "render"):
+        stub = jinja2.Template( indexed_unpacker_template, keep_trailing_newline=True ).render({
+            "fingerprint": fingerprint,
+            "filename": filename or output_name(out),
+            "trailer_size": len(index_trailer.format(0, 0)),
+            **UNPACKER_SETTINGS,
+        }).encode("utf-8")
+
+    # Offsets are counted from the start of the pack, wherever the
+    # stream it is written to starts
+    with open_output(out) as stream:
+        with measure(stats, "write") as counts:
+            offset = counts["bytes"] = stream.write(stub)
+
+        # Every block is followed by a newline, ending its last comment.
+        # Files are read and blocks are encoded on separate thread pools
+        encoded = map_ordered(lambda group: encode_indexed_block(group, codec, cache, exact, stats), iter_groups(), jobs)
+        for block_codec, data in encoded:
+            blocks.append((offset, len(data), block_codec))
+            with measure(stats, "write", label=f"block {len(blocks) - 1}") as counts:
+                counts["bytes"] = stream.write(data) + stream.write(b"\n")
+            offset += counts["bytes"]
+
+        # The index is wrapped into comment lines of the same width as
+        # the base85 lines, the unpacker joins them back before parsing
+        with measure(stats, "render"):
+            index = json.dumps({
+                "dirs": make_dir_trie(dirs),
+                "blocks": blocks,
+                "members": members,
+            }, separators=(",", ":")).encode("ascii")
+        with measure(stats, "write") as counts:
+            length = 0
+            for i in range(0, len(index), B85_LINE_WIDTH):
+                length += stream.write(b"#" + index[i:i + B85_LINE_WIDTH] + b"\n")
+            counts["bytes"] = length + stream.write(index_trailer.format(offset, length).encode("ascii"))
+    return offset + counts["bytes"]
+
+@functools.lru_cache(maxsize=None)
+def packer_source() -> bytes:
+    """Reads the source of this module once, so packs made by another version are never up to date"""
+
+    return Path(__file__).read_bytes()
+
+def compute_fingerprint(files: List[Tuple[Path, os.stat_result]], dirs: List[Path], root_dir: Path,
+                        filename: str, options: Dict[str, Any]) -> str:
+    """
+    Computes a digest of everything a pack is generated from: the
+    packer's own source, holding the templates and the code encoding the
+    payload, the settings rendered into the templates, the options, the
+    directories and the name, size, mtime and inode of every file. Only
+    stats are needed, so it can be checked without reading any contents.
+    """
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(packer_source())
+    fingerprint.update(json.dumps({
+        "filename": filename,
+        "options": options,
+        "settings": UNPACKER_SETTINGS,
+        "dirs": [str(d) for d in dirs],
+        "files": [
+            (str(item.relative_to(root_dir)), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            for item, stat in files
+        ],
+    }, sort_keys=True, default=str).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+def read_fingerprint(out: Path) -> Optional[str]:
+    """Reads the fingerprint from the first line of a generated file, if there is one"""
+
+    try:
+        with out.open("rb") as stream:
+            match = FINGERPRINT_LINE.fullmatch(stream.readline())
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return match.group(1).decode("ascii") if match else None
+
+class PackResult(NamedTuple):
+    """Outcome of packing one directory with a Packer"""
+
+    # Whether the output was written, False when it was already up to date
+    written: bool
+    # Number of files packed and their total size in bytes
+    files: int
+    bytes: int
+    # Size in bytes of the generated unpacker, 0 when it was not written
+    output_bytes: int
+    # Wall time of the run in seconds
+    seconds: float
+    # Contents of the generated unpacker when it was packed in memory
+    data: Optional[bytes] = None
+    # Per-phase timing of the run when stats were asked for
+    stats: Optional[Stats] = None
+
+class Packer:
+    """
+    Packs directories into self-extracting python files with a fixed set
+    of options, so that many targets can be packed in one process. The
+    ignore rules and the repack cache are set up once and shared by every
+    pack. Options are validated like the command line validates them and
+    invalid combinations raise ValueError.
+
+    `report` is one of REPORT_MODES and defaults to "quiet". With
+    `stats`, every result carries the per-phase timing of its run.
+    """
+
+    def __init__(self, ignore: Iterable[str] = (), ignore_files: bool = True, jobs: int = 1,
+                 fmt: str = "indexed", codec: str = "none", block_size: int = 0,
+                 cache_dir: Optional[Path] = None, cache_size: int = DEFAULT_CACHE_SIZE,
+                 exact: bool = False, report: str = "quiet", stats: bool = False):
+        if fmt not in PACK_FORMATS:
+            raise ValueError(f"Unknown format {fmt!r}")
+        if codec not in COMPRESSORS:
+            raise ValueError(f"Unknown codec {codec!r}")
+        if report not in REPORT_MODES:
+            raise ValueError(f"Unknown report mode {report!r}")
+        if fmt == "legacy" and (codec != "none" or exact or cache_dir is not None):
+            raise ValueError("Compression, byte-exact packing and the cache require the indexed format")
+        if block_size and codec == "none":
+            raise ValueError("A block size requires compression")
+
+        self.ignore = list(ignore)
+        self.ignore_files = ignore_files
+        self.jobs = jobs
+        self.fmt = fmt
+        self.codec = codec
+        self.block_size = block_size
+        self.exact = exact
+        self.report = report
+        self.stats = stats
+        self.matcher = IgnoreMatcher.from_patterns(self.ignore, IGNORE_FILES if ignore_files else ())
+        self.cache = PackCache(cache_dir, cache_size) if cache_dir is not None else None
+
+    def pack(self, inp: Path, out: Union[Path, BinaryIO, None] = None, root_dir: Optional[Path] = None,
+             force: bool = False, stats: Optional[Stats] = None) -> PackResult:
+        """
+        Packs the directory `inp` into `out`, which is a path, a binary
+        file-like object, or None to pack in memory and return the
+        unpacker in the result's `data`. Members are named relative to
+        `root_dir`, which defaults to the parent of `inp`.
+
+        Unless `force` is set, a path output is left untouched when the
+        fingerprint in its first line matches the inputs. Streams are
+        always written. A `stats` instance overrides the one the packer
+        would make, and is filled in.
+        """
+
+        inp = Path(inp)
+        root_dir = inp.parent if root_dir is None else Path(root_dir)
+        if stats is None and self.stats:
+            stats = Stats()
+
+        buffer = io.BytesIO() if out is None else None
+        target = buffer if out is None else out
+        filename = output_name(target)
+
+        files = []
+        dirs = [inp.name]
+        for entry in walk_tree(inp, self.matcher, stats):
+            item = Path(entry.path)
+
+            # Add dirs. Only the paths and stats are kept here, the contents
+            # are read while the output is being written
+            if entry.is_dir():
+                dirs.append(item.relative_to(root_dir))
+            else:
+                files.append((item, entry.stat()))
+
+            # Print the value
+            if self.report == "verbose":
+                print( item.relative_to(root_dir) )
+
+        progress = Progress(len(files), sum(stat.st_size for _, stat in files), self.report == "progress")
+
+        def finish(written: bool, output_bytes: int = 0) -> PackResult:
+            progress.finish()
+            summary = progress.summary()
+            return PackResult(
+                written, summary["files"], summary["bytes"], output_bytes, summary["seconds"],
+                buffer.getvalue() if buffer is not None else None, stats
+            )
+
+        fingerprint = compute_fingerprint(files, dirs, root_dir, filename, {
+            "ignore": self.ignore, "ignore_files": self.ignore_files, "format": self.fmt,
+            "codec": self.codec, "block_size": self.block_size, "exact": self.exact,
         })
+        is_path = isinstance(target, (str, os.PathLike))
+        if is_path and not force and read_fingerprint(Path(target)) == fingerprint:
+            if self.report != "quiet":
+                print(f"{target} is up to date")
+            return finish(False)
+
+        # The writers count the bytes they write, which also holds for
+        # streams that cannot tell their position
+        files = [item for item, _ in files]
+        if self.fmt == "legacy":
+            output_bytes = write_legacy_pack(
+                target, files, dirs, root_dir, self.jobs, fingerprint, progress, stats, filename
+            )
+        else:
+            output_bytes = write_indexed_pack(
+                target, files, dirs, root_dir, self.jobs, self.codec, self.block_size, self.cache,
+                fingerprint, self.exact, progress, stats, filename
+            )
+            if self.cache is not None:
+                self.cache.save(inp)
+
+        return finish(True, output_bytes)
+
+def generate_packed_file(inp: Path, out: Path, ignore_list: List[str], root_dir: Path, print_output=True,
+                         ignore_files: bool = True, jobs: int = 1, fmt: str = "indexed", codec: str = "none",
+                         block_size: int = 0, cache_dir: Optional[Path] = None,
+                         cache_size: int = DEFAULT_CACHE_SIZE, force: bool = False, exact: bool = False,
+                         report: str = "verbose", summary: bool = False, stats: Optional[Stats] = None,
+                         stats_format: Optional[str] = None) -> bool:
+    """
+    Packs an entire directory of plain text files into one single
+    python file. The output is streamed to disk one file at a time,
+    so peak memory is bounded by the largest file rather than the
+    whole tree.
+
+    Unless `force` is set, the output is left untouched when the
+    fingerprint in its first line matches the inputs, and False is
+    returned. Returns True when the output was written.
+
+    `report` is one of REPORT_MODES, and is "quiet" when `print_output`
+    is False. With `summary`, a JSON line with the counts and timing of
+    the run is printed at the end. With `stats`, the time spent in each
+    phase of the run is recorded in it, and printed before the summary
+    as a table on stderr or a JSON line when `stats_format` is "table"
+    or "json".
+    """
+
+    packer = Packer(
+        ignore_list, ignore_files, jobs, fmt, codec, block_size, cache_dir, cache_size, exact,
+        report if print_output else "quiet"
     )
+    result = packer.pack(inp, out, root_dir, force, stats)
+    if stats_format == "json":
+        print(json.dumps(stats.to_dict()))
+    elif stats_format == "table":
+        print(stats.format_table(), file=sys.stderr)
+    if summary:
+        print(json.dumps({
+            "output": str(out), "written": result.written, "files": result.files, "bytes": result.bytes,
+            "seconds": result.seconds,
+            "bytes_per_second": round(result.bytes / result.seconds) if result.seconds > 0 else 0,
+        }))
+    return result.written
 
 if __name__ == "__main__":
     args = parse_arguments(sys.argv[1:])
@@ -172,7 +2162,19 @@ if __name__ == "__main__":
     if output_file is None:
         output_file = input_dir.parent/f"{input_dir.name}_packed.py"
 
-    print(f"Packing {input_dir} into {output_file}")
+    if args["report"] != "quiet":
+        print(f"Packing {input_dir} into {output_file}")
     
     # Actually perform the packing
-    generate_packed_file(input_dir, output_file, args["ignore"], root_dir)
+    stats = None
+    if args["stats"] or args["trace"] or args["memory_profile"]:
+        stats = Stats(trace=args["trace"] is not None, memory=args["memory_profile"])
+    generate_packed_file(input_dir, output_file, args["ignore"], root_dir,
+                         ignore_files=args["ignore_files"], jobs=args["jobs"], fmt=args["format"],
+                         codec=args["compress"], block_size=args["block_size"],
+                         cache_dir=args["cache"], cache_size=args["cache_size"], force=args["force"],
+                         exact=args["byte_exact"], report=args["report"], summary=args["summary"], stats=stats,
+                         stats_format=args["stats"] or ("table" if args["memory_profile"] else None))
+
+    if args["trace"] is not None:
+        stats.write_trace(args["trace"])